@@ -3,12 +3,16 @@
 
 import os
 import re
+import time
+import uuid
+import asyncio
 import sqlite3
 import shutil
 import hashlib
 import logging
 from pathlib import Path
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 from telegram import (
     Update,
@@ -69,6 +73,27 @@ AUTO_BACKUP_MINUTES = int(os.getenv("AUTO_BACKUP_MINUTES", "60"))
 BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "30"))
 SILENT_BACKUP_TO_OWNER = os.getenv("SILENT_BACKUP_TO_OWNER", "false").strip().lower() == "true"
 TRASH_RETENTION_DAYS = int(os.getenv("TRASH_RETENTION_DAYS", "30"))
+DB_READERS = max(1, int(os.getenv("DB_READERS", "4")))
+SUBJECT_PAGE_SIZE = int(os.getenv("SUBJECT_PAGE_SIZE", "20"))
+CONCURRENT_UPDATES = max(1, int(os.getenv("CONCURRENT_UPDATES", "8")))
+INSERT_BATCH_WINDOW = float(os.getenv("INSERT_BATCH_WINDOW", "0.1"))
+INSERT_BATCH_MAX = max(1, int(os.getenv("INSERT_BATCH_MAX", "32")))
+SUBJECT_COUNTS_TTL = int(os.getenv("SUBJECT_COUNTS_TTL", "30"))
+ALBUM_SUMMARY_DELAY = float(os.getenv("ALBUM_SUMMARY_DELAY", "1.5"))
+LIST_CACHE_TTL = int(os.getenv("LIST_CACHE_TTL", "30"))
+READ_CACHE_MAX = max(1, int(os.getenv("READ_CACHE_MAX", "1024")))
+
+# SQLite tuning (لكل اتصال بالـpool)
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "20000"))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(128 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "8192"))
+# SQLite يتجاهل أي قيمة ثانية بصمت، فـinit_db يعيد VACUUM بكل تشغيل
+if not (512 <= DB_PAGE_SIZE <= 65536 and DB_PAGE_SIZE & (DB_PAGE_SIZE - 1) == 0):
+    raise SystemExit("❌ DB_PAGE_SIZE لازم power of 2 بين 512 و 65536")
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", "256"))  # prepared statements لكل اتصال
+DB_OPTIMIZE_MINUTES = int(os.getenv("DB_OPTIMIZE_MINUTES", "10"))  # PRAGMA optimize دوري (0 = بس عند الإغلاق)
+DB_CHECKPOINT_WRITES = int(os.getenv("DB_CHECKPOINT_WRITES", "500"))  # wal_checkpoint(TRUNCATE) كل N كتابة (0 = تعطيل)
 
 SUBJECTS = [
     "Poetry",
@@ -94,34 +119,39 @@ SUBJECT_EMOJI = {
     "Listening and speaking": "🎧",
 }
 
+# lower -> الاسم الأصلي (lookup واحد بدل المرور على كل المواد)
+_SUBJECTS_LOWER = {s.casefold(): s for s in SUBJECTS}
+SUBJECT_SET = frozenset(SUBJECTS)
+
 # ============================================================
 # UTIL
 # ============================================================
-def utcnow_str():
-    return datetime.utcnow().isoformat(timespec="seconds")
-
 def ensure_dirs():
     Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
     Path(FILES_DIR).mkdir(parents=True, exist_ok=True)
     Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
 
+def clear_modes(ud: dict, *keys):
+    for k in keys:
+        ud.pop(k, None)
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+_RE_UNSAFE_FILENAME = re.compile(r"[^\w\-. ()\[\]{}]+", re.UNICODE)
+
 def safe_filename(name: str, fallback: str) -> str:
     name = (name or "").strip()
     if not name:
         return fallback
-    name = re.sub(r"[^\w\-. ()\[\]{}]+", "_", name, flags=re.UNICODE)
+    name = _RE_UNSAFE_FILENAME.sub("_", name)
     name = name.strip(" ._")
     return name or fallback
 
+@lru_cache(maxsize=1024)
 def normalize_subject(text: str):
-    t = (text or "").strip()
-    for s in SUBJECTS:
-        if t.lower() == s.lower():
-            return s
-    return None
+    # handle_text يعمل strip مرة وحدة عند الاستلام
+    return _SUBJECTS_LOWER.get((text or "").casefold())
 
 def sha256_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
     h = hashlib.sha256()
@@ -136,16 +166,23 @@ def sha256_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
 # ============================================================
 # KEYBOARDS
 # ============================================================
-def main_keyboard_for(uid: int):
+def _build_main_keyboard(admin: bool):
     rows = [
         [KeyboardButton("📚 المواد"), KeyboardButton("🧾 آخر الملفات")],
         [KeyboardButton("⭐ المفضلة"), KeyboardButton("🔎 بحث")],
     ]
-    if is_admin(uid):
+    if admin:
         rows.append([KeyboardButton("🗑️ سلة المهملات")])
     rows.append([KeyboardButton("📦 نسخة احتياطية"), KeyboardButton("ℹ️ مساعدة")])
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
+# ثابتة: تنبني مرة وحدة عند الاستيراد
+MAIN_KB_ADMIN = _build_main_keyboard(True)
+MAIN_KB_VIEWER = _build_main_keyboard(False)
+
+def main_keyboard_for(uid: int):
+    return MAIN_KB_ADMIN if is_admin(uid) else MAIN_KB_VIEWER
+
 # ============================================================
 # SAFE MESSAGE EDIT HELPERS (لمنع تراكم الرسائل)
 # ============================================================
@@ -195,20 +232,166 @@ async def finalize_status(status_msg, context: ContextTypes.DEFAULT_TYPE, chat_i
 # DB
 # ============================================================
 def db():
+    """
+    اتصال قصير للـstartup/migrations فقط (قبل الـpool).
+    الـPRAGMAs تنضبط مرة وحدة بـ init_db وبالـpool مو بكل اتصال.
+    """
     con = sqlite3.connect(DB_PATH)
     con.row_factory = sqlite3.Row
+    return con
+
+# ---------------------------
+# POOL: 1 RW + N RO (WAL)
+# ---------------------------
+_rw_con = None
+_rw_lock = None
+_readers = None
+_writes_since_checkpoint = 0
+
+# يتفعل بـ init_db إذا SQLite يدعم FTS5 مع tokenizer الـtrigram (3.34+)
+FTS_ENABLED = False
+
+# أكبر rowid ممكن: "من الأحدث" بالـ keyset pagination
+MAX_ROWID = (1 << 63) - 1
+
+def _apply_pragmas(con):
+    # page cache بالـRAM (قيمة سالبة = KiB) + mmap للقراءة + انتظار بدل SQLITE_BUSY
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_KB};")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES};")
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+
+def _connect_rw():
+    # autocommit: statement واحد = transaction واحد؛ الدفعات تفتح BEGIN بنفسها
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STMT_CACHE, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL;")
+    # NORMAL بـWAL: بدون fsync لكل commit؛ آمن مع crash للبرنامج،
+    # وممكن نخسر آخر commits فقط إذا انقطعت الكهرباء عن السيرفر
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA wal_autocheckpoint=1000;")
+    _apply_pragmas(con)
+    return con
+
+def _connect_ro():
+    uri = Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    con = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=DB_STMT_CACHE)
+    con.row_factory = sqlite3.Row
+    _apply_pragmas(con)
+    return con
+
+def _open_connections():
+    global _rw_con
+    # الكاتب أولاً حتى يتفعل WAL وينخلق ملف shm قبل القرّاء
+    _rw_con = _connect_rw()
+    for _ in range(DB_READERS):
+        _readers.put_nowait(_connect_ro())
+
+async def _close_connections():
+    global _rw_con
+    for _ in range(DB_READERS):
+        con = await _readers.get()
+        con.close()
+    if _rw_con is not None:
+        _rw_con.close()
+        _rw_con = None
+
+async def open_db_pool(app=None):
+    global _rw_lock, _readers
+    _rw_lock = asyncio.Lock()
+    _readers = asyncio.Queue()
+    _open_connections()
+    log.info("DB pool ready: 1 rw + %s ro", DB_READERS)
+
+async def close_db_pool(app=None):
+    if _readers is None:
+        return
+    async with _rw_lock:
+        # آخر فرصة يحدّث SQLite إحصائيات الـplanner قبل الإغلاق
+        try:
+            await _in_thread(_rw_con.execute, "PRAGMA optimize;")
+        except Exception:
+            pass
+        await _close_connections()
+
+@asynccontextmanager
+async def acquire_reader():
+    con = await _readers.get()
     try:
-        con.execute("PRAGMA journal_mode=WAL;")
-        con.execute("PRAGMA synchronous=NORMAL;")
-        con.execute("PRAGMA temp_store=MEMORY;")
+        yield con
+    finally:
+        _readers.put_nowait(con)
+
+def _checkpoint_truncate(con):
+    # autocheckpoint يرجّع الصفحات بس ما يصغّر ملف الـ-wal؛ TRUNCATE يصفّره
+    try:
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
     except Exception:
         pass
-    return con
+
+@asynccontextmanager
+async def acquire_writer():
+    global _writes_since_checkpoint
+    async with _rw_lock:
+        yield _rw_con
+        _writes_since_checkpoint += 1
+        if DB_CHECKPOINT_WRITES > 0 and _writes_since_checkpoint >= DB_CHECKPOINT_WRITES:
+            _writes_since_checkpoint = 0
+            await _in_thread(_checkpoint_truncate, _rw_con)
+
+async def _in_thread(fn, *args):
+    # كل شغل SQLite / قراءة ملفات يمر من هنا حتى ما يوقف الـevent loop
+    return await asyncio.to_thread(fn, *args)
+
+def _fetchall(con, sql: str, params=()):
+    return con.execute(sql, params).fetchall()
+
+def _fetchone(con, sql: str, params=()):
+    return con.execute(sql, params).fetchone()
+
+def _execute(con, sql: str, params=()):
+    return con.execute(sql, params)
+
+async def read_all(sql: str, params=()):
+    async with acquire_reader() as con:
+        return await _in_thread(_fetchall, con, sql, params)
+
+async def read_one(sql: str, params=()):
+    async with acquire_reader() as con:
+        return await _in_thread(_fetchone, con, sql, params)
+
+async def write(sql: str, params=()):
+    async with acquire_writer() as con:
+        return await _in_thread(_execute, con, sql, params)
+
+async def write_one(sql: str, params=()):
+    """
+    كتابة مع RETURNING: يرجّع أول صف من نفس الـstatement.
+    """
+    async with acquire_writer() as con:
+        return await _in_thread(_fetchone, con, sql, params)
 
 def init_db():
     con = db()
     cur = con.cursor()
 
+    # page_size لازم ينضبط قبل WAL؛ على DB موجود يتطبق بـVACUUM (مرة وحدة)
+    try:
+        cur.execute("PRAGMA page_size")
+        if cur.fetchone()[0] != DB_PAGE_SIZE:
+            cur.execute("PRAGMA journal_mode=DELETE;")
+            cur.execute(f"PRAGMA page_size={DB_PAGE_SIZE};")
+            cur.execute("VACUUM;")
+            log.info("DB page_size set to %s", DB_PAGE_SIZE)
+    except Exception as e:
+        log.warning("page_size change skipped: %s", e)
+
+    # WAL يبقى محفوظ بملف الـDB، يكفي نضبطه مرة وحدة
+    try:
+        cur.execute("PRAGMA journal_mode=WAL;")
+    except Exception:
+        pass
+
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS files (
@@ -234,7 +417,7 @@ def init_db():
     # Migration
     try:
         cur.execute("PRAGMA table_info(files)")
-        cols = {row[1] for row in cur.fetchall()}
+        cols = {row["name"] for row in cur.fetchall()}
 
         if "local_path" not in cols:
             cur.execute("ALTER TABLE files ADD COLUMN local_path TEXT")
@@ -253,16 +436,89 @@ def init_db():
     except Exception:
         pass
 
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_user_subject ON files(user_id, subject);")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_files_user_added ON files(user_id, added_at);")
+    # (user_id, is_deleted) + rowid يخدم list_recent / list_trash بدون sort
     cur.execute("CREATE INDEX IF NOT EXISTS idx_files_deleted ON files(user_id, is_deleted);")
 
+    # pagination حسب المادة والمفضلة: index seek + LIMIT بدون TEMP B-TREE
+    cur.execute("DROP INDEX IF EXISTS idx_files_user_subject;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_user_subj_id ON files(user_id, subject, id DESC) WHERE is_deleted=0;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_user_fav_id ON files(user_id, is_fav, id DESC) WHERE is_deleted=0;")
+
     # unique by tg_unique_id
     cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_user_unique ON files(user_id, tg_unique_id);")
     # unique by file content hash
     cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_user_hash ON files(user_id, content_hash);")
 
+    # FTS5 trigram للبحث (external-content فوق جدول files + triggers للمزامنة).
+    # trigram (SQLite 3.34+) يخدم LIKE '%q%' بالـindex: نفس نتائج البحث القديم
+    # (المحاضرة / والمراجعة / chapter12) بدل مطابقة كلمات كاملة فقط
+    global FTS_ENABLED
+    try:
+        cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='files_fts'")
+        row = cur.fetchone()
+        fts_existed = row is not None and "trigram" in row[0]
+        if row is not None and not fts_existed:
+            # نسخة unicode61 القديمة: نمسحها ونبنيها من جديد
+            for trg in ("files_fts_ai", "files_fts_ad", "files_fts_au"):
+                cur.execute(f"DROP TRIGGER IF EXISTS {trg};")
+            cur.execute("DROP TABLE files_fts;")
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                subject, filename, caption,
+                content='files', content_rowid='id',
+                tokenize='trigram'
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_ai AFTER INSERT ON files BEGIN
+                INSERT INTO files_fts(rowid, subject, filename, caption)
+                VALUES (new.id, new.subject, new.filename, new.caption);
+            END;
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_ad AFTER DELETE ON files BEGIN
+                INSERT INTO files_fts(files_fts, rowid, subject, filename, caption)
+                VALUES ('delete', old.id, old.subject, old.filename, old.caption);
+            END;
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS files_fts_au AFTER UPDATE OF subject, filename, caption ON files BEGIN
+                INSERT INTO files_fts(files_fts, rowid, subject, filename, caption)
+                VALUES ('delete', old.id, old.subject, old.filename, old.caption);
+                INSERT INTO files_fts(rowid, subject, filename, caption)
+                VALUES (new.id, new.subject, new.filename, new.caption);
+            END;
+            """
+        )
+        if not fts_existed:
+            cur.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+        FTS_ENABLED = True
+    except sqlite3.OperationalError as e:
+        log.warning("FTS5 unavailable, search falls back to LIKE: %s", e)
+        FTS_ENABLED = False
+
     con.commit()
+
+    # إحصائيات للـplanner (مرة وحدة لما تكون ناقصة) حتى يختار الـindexes
+    try:
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1'")
+        has_stats = cur.fetchone() is not None
+        if has_stats:
+            cur.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl='files' LIMIT 1")
+            has_stats = cur.fetchone() is not None
+        if not has_stats:
+            cur.execute("ANALYZE;")
+            con.commit()
+    except Exception:
+        pass
     con.close()
 
 def db_has_data() -> bool:
@@ -285,15 +541,13 @@ def seed_db_if_needed():
     if seed.exists() and seed.is_file() and seed.stat().st_size > 10_000:
         shutil.copy2(str(seed), DB_PATH)
 
-def detect_library_id_legacy() -> int:
+def detect_library_id_legacy(con) -> int:
     try:
-        con = db()
         cur = con.cursor()
 
         if OWNER_ID:
             cur.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=0", (OWNER_ID,))
             if cur.fetchone()[0] > 0:
-                con.close()
                 return OWNER_ID
 
         cur.execute("""
@@ -305,45 +559,138 @@ def detect_library_id_legacy() -> int:
             LIMIT 1
         """)
         row = cur.fetchone()
-        con.close()
         if row:
-            return int(row[0])
+            return int(row["user_id"])
         return 0
     except Exception:
         return 0
 
-def library_has_any_files(user_id: int) -> bool:
+def library_has_any_files(con, user_id: int) -> bool:
     try:
-        con = db()
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=0", (user_id,))
         n = cur.fetchone()[0]
-        con.close()
         return n > 0
     except Exception:
         return False
 
-def get_file_by_unique(user_id: int, tg_unique_id: str):
+async def get_file_by_unique(user_id: int, tg_unique_id: str):
     if not tg_unique_id:
         return None
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM files WHERE user_id=? AND tg_unique_id=? LIMIT 1", (user_id, tg_unique_id))
-    row = cur.fetchone()
-    con.close()
-    return row
+    return await read_one("SELECT * FROM files WHERE user_id=? AND tg_unique_id=? LIMIT 1", (user_id, tg_unique_id))
 
-def get_file_by_hash(user_id: int, content_hash: str):
+async def get_file_by_hash(user_id: int, content_hash: str):
     if not content_hash:
         return None
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM files WHERE user_id=? AND content_hash=? LIMIT 1", (user_id, content_hash))
-    row = cur.fetchone()
-    con.close()
-    return row
+    return await read_one("SELECT * FROM files WHERE user_id=? AND content_hash=? LIMIT 1", (user_id, content_hash))
 
-def add_file_row(
+# ---------------------------
+# INSERT BATCHING (ألبومات / media groups)
+# ---------------------------
+_insert_batch = []  # [(params, future)]
+_insert_flush_handle = None  # TimerHandle للـflush الجاي
+_bg_tasks = set()
+
+# added_at / deleted_at تنحسب داخل SQLite بصيغة ISO (UTC, ثواني): strftime('%Y-%m-%dT%H:%M:%S','now')
+_INSERT_FILE_SQL = """
+    INSERT INTO files (user_id, subject, file_type, tg_file_id, tg_unique_id, filename, caption, local_path, file_size, content_hash, added_at, is_fav, is_deleted)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%S','now'), 0, 0)
+    ON CONFLICT(user_id, tg_unique_id) DO UPDATE SET
+        subject=excluded.subject,
+        tg_file_id=excluded.tg_file_id,
+        filename=COALESCE(excluded.filename, filename),
+        caption=COALESCE(excluded.caption, caption),
+        local_path=COALESCE(excluded.local_path, local_path),
+        file_size=COALESCE(excluded.file_size, file_size),
+        content_hash=COALESCE(excluded.content_hash, content_hash),
+        is_deleted=0,
+        deleted_at=NULL
+    WHERE files.is_deleted=1
+"""
+# upsert: نفس الـtg_unique_id بالسلة يرجع لنفس الصف (UPDATE بمكانه) بدل صف جديد؛
+# إذا الصف حي الـWHERE يمنع التحديث = ماكو صف متأثر = تكرار
+# RETURNING (SQLite 3.35+): الـid يرجع من نفس الـstatement بدل lastrowid
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+if _HAS_RETURNING:
+    _INSERT_FILE_SQL += "RETURNING id"
+
+def _insert_rows(con, batch):
+    """
+    كل صفوف الدفعة بـ transaction واحد (commit/fsync واحد).
+    تكرار صف واحد ما يفشّل الباقي: نرجع الخطأ مكانه.
+    """
+    results = []
+    # IMMEDIATE: ناخذ قفل الكتابة من البداية (busy_timeout يشتغل هنا) بدل ما يفشل بنص الدفعة
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        for params in batch:
+            try:
+                cur = con.execute(_INSERT_FILE_SQL, params)
+                if _HAS_RETURNING:
+                    row = cur.fetchone()
+                    if row is None:
+                        raise sqlite3.IntegrityError("duplicate tg_unique_id")
+                    results.append(row[0])
+                elif cur.rowcount == 0:
+                    raise sqlite3.IntegrityError("duplicate tg_unique_id")
+                elif params[4]:
+                    # lastrowid ما يتحدث بمسار الـUPDATE
+                    results.append(con.execute(
+                        "SELECT id FROM files WHERE user_id=? AND tg_unique_id=?", (params[0], params[4])
+                    ).fetchone()[0])
+                else:
+                    results.append(cur.lastrowid)
+            except sqlite3.IntegrityError as e:
+                results.append(e)
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    return results
+
+async def _flush_insert_batch():
+    global _insert_batch, _insert_flush_handle
+    batch, _insert_batch = _insert_batch, []
+    if _insert_flush_handle is not None:
+        _insert_flush_handle.cancel()
+        _insert_flush_handle = None
+    if batch:
+        await _write_insert_batch(batch)
+
+async def _write_insert_batch(batch):
+    """
+    يكتب [(params, future)] بـtransaction واحد ويحط الـid (أو الخطأ) بكل future.
+    """
+    try:
+        async with acquire_writer() as con:
+            results = await _in_thread(_insert_rows, con, [params for params, _ in batch])
+    except Exception as e:
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    for user_id in {params[0] for params, _ in batch}:
+        invalidate_read_cache(user_id)
+    for (_, fut), res in zip(batch, results):
+        if fut.done():
+            continue
+        if isinstance(res, Exception):
+            fut.set_exception(res)
+        else:
+            fut.set_result(res)
+    if len(batch) > 1:
+        log.info("insert batch flushed: %s rows", len(batch))
+
+def _start_insert_flush():
+    _spawn(_flush_insert_batch())
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+async def add_file_row(
     user_id: int,
     subject: str,
     file_type: str,
@@ -354,109 +701,117 @@ def add_file_row(
     local_path: str | None,
     file_size: int | None,
     content_hash: str | None,
+    album_id: str | None = None,
 ):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO files (user_id, subject, file_type, tg_file_id, tg_unique_id, filename, caption, local_path, file_size, content_hash, added_at, is_fav, is_deleted)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0)
-        """,
-        (user_id, subject, file_type, tg_file_id, tg_unique_id, filename, caption, local_path, file_size, content_hash, utcnow_str()),
-    )
-    con.commit()
-    new_id = cur.lastrowid
-    con.close()
-    return new_id
-
-def update_existing_file_from_duplicate(
-    user_id: int,
-    existing_id: int,
-    tg_file_id: str,
-    filename: str | None,
-    caption: str | None,
-    local_path: str | None,
-    file_size: int | None,
-    content_hash: str | None,
-):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        """
-        UPDATE files
-        SET tg_file_id=?,
-            filename=COALESCE(?, filename),
-            caption=COALESCE(?, caption),
-            local_path=COALESCE(?, local_path),
-            file_size=COALESCE(?, file_size),
-            content_hash=COALESCE(?, content_hash),
-            is_deleted=0,
-            deleted_at=NULL
-        WHERE user_id=? AND id=?
-        """,
-        (tg_file_id, filename, caption, local_path, file_size, content_hash, user_id, existing_id),
-    )
-    con.commit()
-    con.close()
+    """
+    يضيف الصف لدفعة تنكتب بعد INSERT_BATCH_WINDOW ثانية (أو فوراً لما توصل
+    INSERT_BATCH_MAX صف) ويرجّع الـid.
+    صفوف الألبوم تنتظر باقي ملفات نفس الـmedia_group وتنكتب وياها بدفعة وحدة.
+    نفس الـtg_unique_id بالسلة يرجع لنفس الصف ونفس الـid.
+    يرفع sqlite3.IntegrityError إذا الصف مكرر.
+    """
+    global _insert_flush_handle
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    params = (user_id, subject, file_type, tg_file_id, tg_unique_id, filename, caption, local_path, file_size, content_hash)
+    if album_id and album_add_row(album_id, params, fut):
+        return await fut
+    _insert_batch.append((params, fut))
+    if len(_insert_batch) >= INSERT_BATCH_MAX:
+        _start_insert_flush()
+    elif _insert_flush_handle is None:
+        _insert_flush_handle = loop.call_later(INSERT_BATCH_WINDOW, _start_insert_flush)
+    return await fut
+
+async def count_by_subject(user_id: int):
+    rows = await read_all("SELECT subject, COUNT(*) cnt FROM files WHERE user_id=? AND is_deleted=0 GROUP BY subject", (user_id,))
+    return [(r["subject"], r["cnt"]) for r in rows]
 
-def count_by_subject(user_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT subject, COUNT(*) cnt FROM files WHERE user_id=? AND is_deleted=0 GROUP BY subject", (user_id,))
-    rows = cur.fetchall()
-    con.close()
-    return [(r[0], r[1]) for r in rows]
+# ---------------------------
+# READ CACHE (عدّادات / صفحات المواد / ملف واحد)
+# ---------------------------
+# key = (user_id, نوع, ...) -> (expires_at, value)؛ أي كتابة للمكتبة تمسح مفاتيحها
+_read_cache = {}
+_read_cache_gen = 0  # يزيد مع كل invalidation (حتى قراءة قديمة ما ترجع للكاش)
+_MISS = object()
+
+def invalidate_read_cache(user_id: int | None = None):
+    global _read_cache_gen
+    _read_cache_gen += 1
+    if user_id is None:
+        _read_cache.clear()
+        return
+    for key in [k for k in _read_cache if k[0] == user_id]:
+        del _read_cache[key]
 
-def list_files_by_subject(user_id: int, subject: str, limit: int = 50):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT id, file_type, filename, caption, added_at, is_fav
-        FROM files
-        WHERE user_id=? AND subject=? AND is_deleted=0
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (user_id, subject, limit),
+async def cached_read(key: tuple, ttl: int, fetch):
+    """
+    يرجّع القيمة من الكاش إذا ما انتهت، وإلا ينفذ fetch() ويحفظ النتيجة.
+    """
+    hit = _read_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    gen = _read_cache_gen
+    value = await fetch()
+    if gen == _read_cache_gen:  # ما صارت كتابة أثناء القراءة
+        if len(_read_cache) >= READ_CACHE_MAX:
+            _read_cache.pop(next(iter(_read_cache)))  # الأقدم إدخالاً
+        _read_cache[key] = (time.monotonic() + ttl, value)
+    return value
+
+async def list_files_by_subject(user_id: int, subject: str, limit: int = 50, before_id: int = 0):
+    """
+    Keyset pagination: الملفات الأقدم من before_id (0 = من الأحدث).
+    """
+    return await cached_read(
+        (user_id, "subj", subject, before_id, limit),
+        LIST_CACHE_TTL,
+        lambda: read_all(
+            """
+            SELECT id, file_type, filename, caption, added_at, is_fav
+            FROM files
+            WHERE user_id=? AND subject=? AND is_deleted=0 AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (user_id, subject, before_id or MAX_ROWID, limit),
+        ),
     )
-    rows = cur.fetchall()
-    con.close()
-    return rows
 
-def get_file_by_id(user_id: int, file_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT * FROM files WHERE user_id=? AND id=?", (user_id, file_id))
-    row = cur.fetchone()
-    con.close()
-    return row
+async def get_file_by_id(user_id: int, file_id: int):
+    return await cached_read(
+        (user_id, "file", file_id),
+        LIST_CACHE_TTL,
+        lambda: read_one("SELECT * FROM files WHERE user_id=? AND id=?", (user_id, file_id)),
+    )
 
-def set_fav(user_id: int, file_id: int, fav: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE files SET is_fav=? WHERE user_id=? AND id=?", (fav, user_id, file_id))
-    con.commit()
-    con.close()
+_TOGGLE_FAV_SQL = "UPDATE files SET is_fav=1-is_fav WHERE user_id=? AND id=? AND is_deleted=0"
 
-def soft_delete_file(user_id: int, file_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE files SET is_deleted=1, deleted_at=? WHERE user_id=? AND id=?", (utcnow_str(), user_id, file_id))
-    con.commit()
-    con.close()
+async def toggle_fav(user_id: int, file_id: int):
+    """
+    يقلب is_fav بـUPDATE واحد ويرجّع القيمة الجديدة (None إذا الملف مو موجود أو محذوف).
+    """
+    if _HAS_RETURNING:
+        row = await write_one(_TOGGLE_FAV_SQL + " RETURNING is_fav", (user_id, file_id))
+    else:
+        cur = await write(_TOGGLE_FAV_SQL, (user_id, file_id))
+        row = await read_one("SELECT is_fav FROM files WHERE user_id=? AND id=?", (user_id, file_id)) if cur.rowcount else None
+    invalidate_read_cache(user_id)
+    return int(row["is_fav"]) if row else None
+
+async def soft_delete_file(user_id: int, file_id: int):
+    await write(
+        "UPDATE files SET is_deleted=1, deleted_at=strftime('%Y-%m-%dT%H:%M:%S','now') WHERE user_id=? AND id=?",
+        (user_id, file_id),
+    )
+    invalidate_read_cache(user_id)
 
-def restore_file(user_id: int, file_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("UPDATE files SET is_deleted=0, deleted_at=NULL WHERE user_id=? AND id=?", (user_id, file_id))
-    con.commit()
-    con.close()
+async def restore_file(user_id: int, file_id: int):
+    await write("UPDATE files SET is_deleted=0, deleted_at=NULL WHERE user_id=? AND id=?", (user_id, file_id))
+    invalidate_read_cache(user_id)
 
-def list_recent(user_id: int, limit: int = 10):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
+async def list_recent(user_id: int, limit: int = 10):
+    return await read_all(
         """
         SELECT id, subject, file_type, filename, caption, added_at, is_fav
         FROM files
@@ -466,14 +821,9 @@ def list_recent(user_id: int, limit: int = 10):
         """,
         (user_id, limit),
     )
-    rows = cur.fetchall()
-    con.close()
-    return rows
 
-def list_favorites(user_id: int, limit: int = 50):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
+async def list_favorites(user_id: int, limit: int = 50):
+    return await read_all(
         """
         SELECT id, subject, file_type, filename, caption, added_at, is_fav
         FROM files
@@ -483,47 +833,57 @@ def list_favorites(user_id: int, limit: int = 50):
         """,
         (user_id, limit),
     )
-    rows = cur.fetchall()
-    con.close()
-    return rows
 
-def search_files(user_id: int, q: str, limit: int = 30):
+async def search_files(user_id: int, q: str, limit: int = 30):
+    """
+    بحث substring (LIKE '%q%') بالمادة/الاسم/الوصف.
+    """
+    if not q:
+        return []  # '%%' بالـLIKE يرجّع كل الجدول
     like = f"%{q}%"
-    con = db()
-    cur = con.cursor()
-    cur.execute(
+    # trigram يحتاج 3 حروف على الأقل حتى يستعمل الـindex
+    if FTS_ENABLED and len(q) >= 3:
+        # UNION لكل عمود: OR بين أعمدة الـFTS يصير scan كامل بدل index
+        return await read_all(
+            """
+            SELECT id, subject, file_type, filename, caption, added_at, is_fav
+            FROM files
+            WHERE id IN (
+                SELECT rowid FROM files_fts WHERE subject LIKE ?1
+                UNION SELECT rowid FROM files_fts WHERE filename LIKE ?1
+                UNION SELECT rowid FROM files_fts WHERE caption LIKE ?1
+            )
+              AND user_id=?2 AND is_deleted=0
+            ORDER BY id DESC
+            LIMIT ?3
+            """,
+            (like, user_id, limit),
+        )
+
+    return await read_all(
         """
         SELECT id, subject, file_type, filename, caption, added_at, is_fav
         FROM files
         WHERE user_id=? AND is_deleted=0
-          AND (filename LIKE ? OR caption LIKE ?)
+          AND (subject LIKE ? OR filename LIKE ? OR caption LIKE ?)
         ORDER BY id DESC
         LIMIT ?
         """,
-        (user_id, like, like, limit),
+        (user_id, like, like, like, limit),
     )
-    rows = cur.fetchall()
-    con.close()
-    return rows
 
-def purge_trash(user_id: int):
-    cutoff = datetime.utcnow() - timedelta(days=TRASH_RETENTION_DAYS)
-    con = db()
-    cur = con.cursor()
-    cur.execute(
-        "DELETE FROM files WHERE user_id=? AND is_deleted=1 AND deleted_at < ?",
-        (user_id, cutoff.isoformat(timespec="seconds")),
+async def purge_trash(user_id: int):
+    await write(
+        "DELETE FROM files WHERE user_id=? AND is_deleted=1 AND deleted_at < strftime('%Y-%m-%dT%H:%M:%S','now', ?)",
+        (user_id, f"-{TRASH_RETENTION_DAYS} days"),
     )
-    con.commit()
-    con.close()
+    invalidate_read_cache(user_id)
 
 # ---------------------------
 # TRASH (Admin-only)
 # ---------------------------
-def list_trash(user_id: int, limit: int = 50):
-    con = db()
-    cur = con.cursor()
-    cur.execute(
+async def list_trash(user_id: int, limit: int = 50):
+    return await read_all(
         """
         SELECT id, subject, file_type, filename, caption, deleted_at
         FROM files
@@ -533,38 +893,48 @@ def list_trash(user_id: int, limit: int = 50):
         """,
         (user_id, limit),
     )
-    rows = cur.fetchall()
-    con.close()
-    return rows
 
-def hard_delete_file(user_id: int, file_id: int):
-    con = db()
-    cur = con.cursor()
-    cur.execute("SELECT local_path FROM files WHERE user_id=? AND id=?", (user_id, file_id))
-    row = cur.fetchone()
-    if row and row[0]:
+def _hard_delete(con, user_id: int, file_id: int):
+    row = con.execute("SELECT local_path FROM files WHERE user_id=? AND id=?", (user_id, file_id)).fetchone()
+    # صفوف قديمة (قبل مسارات الـuuid) ممكن تتشارك نفس الملف: ما نمسحه إذا صف ثاني يأشر عليه
+    shared = row and row["local_path"] and con.execute(
+        "SELECT 1 FROM files WHERE local_path=? AND id<>? LIMIT 1", (row["local_path"], file_id)
+    ).fetchone()
+    if row and row["local_path"] and not shared:
         try:
-            Path(row[0]).unlink(missing_ok=True)
+            Path(row["local_path"]).unlink(missing_ok=True)
         except Exception:
             pass
-    cur.execute("DELETE FROM files WHERE user_id=? AND id=?", (user_id, file_id))
-    con.commit()
-    con.close()
+    _execute(con, "DELETE FROM files WHERE user_id=? AND id=?", (user_id, file_id))
+
+async def hard_delete_file(user_id: int, file_id: int):
+    async with acquire_writer() as con:
+        await _in_thread(_hard_delete, con, user_id, file_id)
+    invalidate_read_cache(user_id)
+
+def _library_stats(con, user_id: int):
+    idxs = [r["name"] for r in con.execute("PRAGMA index_list(files)").fetchall()]
+    total = con.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=0", (user_id,)).fetchone()[0]
+    deleted = con.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=1", (user_id,)).fetchone()[0]
+    return "idx_files_user_hash" in idxs, total, deleted
+
+async def library_stats(user_id: int):
+    async with acquire_reader() as con:
+        return await _in_thread(_library_stats, con, user_id)
 
 # ============================================================
 # BACKUP
 # ============================================================
 def make_backup_name() -> str:
-    return f"archive_backup_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.db"
+    return f"archive_backup_{time.strftime('%Y%m%d_%H%M%S', time.gmtime())}.db"
 
-def make_sqlite_backup(dest_path: str):
-    src = sqlite3.connect(DB_PATH)
+def make_sqlite_backup(src, dest_path: str):
+    # Online backup API: snapshot متسق حتى مع WAL وكتابات شغالة
     dst = sqlite3.connect(dest_path)
     try:
         src.backup(dst)
     finally:
         dst.close()
-        src.close()
 
 def cleanup_old_backups():
     if BACKUP_KEEP <= 0:
@@ -577,95 +947,208 @@ def cleanup_old_backups():
         except Exception:
             pass
 
+async def read_file_bytes(path: Path) -> bytes:
+    """
+    يقرأ الملف بـthread قبل الإرسال؛ لو نمرر file handle مفتوح، PTB يقراه
+    على الـevent loop ويوقف باقي التحديثات.
+    """
+    return await _in_thread(Path(path).read_bytes)
+
 async def send_backup_to_owner(context: ContextTypes.DEFAULT_TYPE, backup_path: Path, caption: str):
     if OWNER_ID == 0:
         return
     try:
-        with open(backup_path, "rb") as f:
-            await context.bot.send_document(chat_id=OWNER_ID, document=f, filename=backup_path.name, caption=caption)
+        data = await read_file_bytes(backup_path)
+        await context.bot.send_document(chat_id=OWNER_ID, document=data, filename=backup_path.name, caption=caption)
     except Exception:
         pass
 
+async def create_backup() -> Path:
+    """
+    نسخة من DB عبر اتصال قراءة من الـpool (خارج event loop) + تنظيف القديم.
+    """
+    backup_path = Path(BACKUP_DIR) / make_backup_name()
+    async with acquire_reader() as con:
+        await _in_thread(make_sqlite_backup, con, str(backup_path))
+    await _in_thread(cleanup_old_backups)
+    return backup_path
+
+async def optimize_db_job(context: ContextTypes.DEFAULT_TYPE):
+    # SQLite يعيد ANALYZE بس للجداول اللي تغيرت إحصائياتها (رخيص)
+    try:
+        await write("PRAGMA optimize;")
+    except Exception as e:
+        log.warning("PRAGMA optimize failed: %s", e)
+
 async def auto_backup_job(context: ContextTypes.DEFAULT_TYPE):
     try:
-        backup_name = make_backup_name()
-        backup_path = Path(BACKUP_DIR) / backup_name
-        make_sqlite_backup(str(backup_path))
-        cleanup_old_backups()
+        backup_path = await create_backup()
         if not SILENT_BACKUP_TO_OWNER:
             await send_backup_to_owner(context, backup_path, "✅ Auto-backup (DB)")
         log.info("Auto backup created: %s", backup_path.name)
     except Exception as e:
         log.exception("Auto backup failed: %s", e)
 
-def restore_from_latest_backup() -> str:
+def _check_backup(backup: Path) -> str:
+    """
+    ينسخ الـbackup جنب الـDB ويفحص النسخة (quick_check + جدول files).
+    يرجّع مسار النسخة، أو يرفع sqlite3.DatabaseError إذا تالفة.
+    """
+    tmp = f"{DB_PATH}.restore"
+    shutil.copy2(str(backup), tmp)
+    try:
+        con = sqlite3.connect(tmp)
+        try:
+            result = con.execute("PRAGMA quick_check;").fetchone()[0]
+            has_files = con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='files'").fetchone()
+        finally:
+            con.close()
+        if result != "ok" or not has_files:
+            raise sqlite3.DatabaseError(f"quick_check: {result}" if result != "ok" else "no files table")
+    except Exception:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return tmp
+
+def _swap_db(tmp: str):
+    """
+    يبدّل DB_PATH بالنسخة المفحوصة؛ إذا فشل init_db يرجّع الملف القديم كما هو.
+    """
+    old = f"{DB_PATH}.old"
+    had_db = Path(DB_PATH).exists()
+    if had_db:
+        os.replace(DB_PATH, old)
+    try:
+        os.replace(tmp, DB_PATH)
+        init_db()  # ممكن يسوي VACUUM (page_size) على backup قديم
+    except Exception:
+        for suffix in ("-wal", "-shm"):
+            Path(DB_PATH + suffix).unlink(missing_ok=True)
+        if had_db:
+            os.replace(old, DB_PATH)
+        raise
+    Path(old).unlink(missing_ok=True)
+
+async def restore_from_latest_backup() -> str:
     bdir = Path(BACKUP_DIR)
     files = sorted(bdir.glob("archive_backup_*.db"), key=lambda p: p.stat().st_mtime, reverse=True)
     if not files:
         return "❌ ماكو أي Backup داخل السيرفر."
     latest = files[0]
-    shutil.copy2(str(latest), DB_PATH)
+
+    # الفحص قبل ما نلمس الـpool: backup تالف ما يوقف البوت
+    try:
+        tmp = await _in_thread(_check_backup, latest)
+    except Exception as e:
+        log.error("restore rejected %s: %s", latest.name, e)
+        return f"❌ الـBackup تالف، ما تغيّر شي: {latest.name}"
+
+    # نسكّر كل اتصالات الـpool قبل استبدال الملف (حتى ما يبقى WAL قديم)
+    async with _rw_lock:
+        await _close_connections()
+        try:
+            await _in_thread(_swap_db, tmp)
+        except Exception as e:
+            log.exception("restore failed, old DB kept: %s", e)
+            return f"❌ فشل الاسترجاع، رجعت القاعدة القديمة: {e}"
+        finally:
+            # هنا DB_PATH يا الـbackup المفحوص يا الملف القديم
+            _open_connections()
+            invalidate_read_cache()
     return f"✅ تم الاسترجاع من: {latest.name}"
 
 # ============================================================
 # UI helpers
 # ============================================================
-def subjects_keyboard(user_id: int):
-    counts = dict(count_by_subject(user_id))
+def button_label(name: str, max_len: int) -> str:
+    """
+    أول سطر فقط (partition ما يقسم الوصف كله) + قص للطول.
+    """
+    first = name.partition("\n")[0].strip()
+    if len(first) > max_len:
+        first = first[:max_len - 3] + "…"
+    return first
+
+async def subject_counts(user_id: int) -> dict:
+    """
+    عدد الملفات لكل مادة، محفوظ لمدة SUBJECT_COUNTS_TTL ومشترك بين كل
+    المستخدمين؛ الكتابات تمسحه (invalidate_read_cache) فما يطلع قديم.
+    """
+    async def fetch():
+        return dict(await count_by_subject(user_id))
+    return await cached_read((user_id, "counts"), SUBJECT_COUNTS_TTL, fetch)
+
+# أزرار الرجوع ثابتة (الأزرار immutable بـPTB 20) فتنبني مرة وحدة
+BTN_BACK_HOME = InlineKeyboardButton("↩️ رجوع", callback_data="back:home")
+BTN_BACK_SUBJECTS = InlineKeyboardButton("↩️ رجوع", callback_data="back:subjects")
+BTN_BACK_TO_SUBJECTS = InlineKeyboardButton("↩️ رجوع للمواد", callback_data="back:subjects")
+BTN_BACK_TRASH = InlineKeyboardButton("↩️ رجوع", callback_data="back:trash")
+
+def subjects_keyboard(counts: dict):
+    return _subjects_keyboard(tuple(counts.get(s, 0) for s in SUBJECTS))
+
+@lru_cache(maxsize=64)
+def _subjects_keyboard(cnts: tuple):
+    """
+    الكيبورد يتغير بس لما تتغير العدّادات، فنحفظه حسب tuple العدّادات.
+    """
     items = []
-    for s in SUBJECTS:
+    for s, cnt in zip(SUBJECTS, cnts):
         emoji = SUBJECT_EMOJI.get(s, "📘")
-        cnt = counts.get(s, 0)
         items.append(InlineKeyboardButton(f"{emoji} {s} ({cnt})", callback_data=f"subj:{s}"))
     buttons = []
     for i in range(0, len(items), 2):
         buttons.append(items[i:i+2])
-    buttons.append([InlineKeyboardButton("↩️ رجوع", callback_data="back:home")])
+    buttons.append([BTN_BACK_HOME])
     return InlineKeyboardMarkup(buttons)
 
-def files_keyboard(rows):
+def files_keyboard(rows, subject: str, before_id: int = 0, has_more: bool = False):
     items = []
     for r in rows:
         fid = int(r["id"])
-        name = (r["filename"] or "").strip() or (r["caption"] or f"file_{fid}")
-        clean = name.replace("\n", " ").strip()
-        if len(clean) > 26:
-            clean = clean[:23] + "…"
+        name = r["filename"] or r["caption"] or f"file_{fid}"
+        clean = button_label(name, 26)
         items.append(InlineKeyboardButton(f"📄 {clean}", callback_data=f"open:{fid}"))
     buttons = []
     for i in range(0, len(items), 2):
         buttons.append(items[i:i+2])
-    buttons.append([InlineKeyboardButton("↩️ رجوع للمواد", callback_data="back:subjects")])
+    nav = []
+    if before_id:
+        nav.append(InlineKeyboardButton("⏮️ الأحدث", callback_data=f"subj:{subject}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("▶️ الأقدم", callback_data=f"subj:{subject}:{int(rows[-1]['id'])}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([BTN_BACK_TO_SUBJECTS])
     return InlineKeyboardMarkup(buttons)
 
+# الكيبوردات حسب (file_id, حالة) ثابتة ومحتاجينها بكل فتح ملف -> lru_cache
+@lru_cache(maxsize=1024)
 def manage_keyboard_admin(file_id: int, is_fav: int, is_deleted: int):
     fav_btn = InlineKeyboardButton("⭐ إزالة من المفضلة" if is_fav else "⭐ إضافة للمفضلة", callback_data=f"fav:{file_id}")
     if is_deleted:
         restore_btn = InlineKeyboardButton("♻️ استرجاع", callback_data=f"restore:{file_id}")
-        return InlineKeyboardMarkup([[restore_btn], [InlineKeyboardButton("↩️ رجوع", callback_data="back:trash")]])
+        return InlineKeyboardMarkup([[restore_btn], [BTN_BACK_TRASH]])
     del_confirm = InlineKeyboardButton("🗑️ حذف (تأكيد)", callback_data=f"del2:{file_id}")
-    back_btn = InlineKeyboardButton("↩️ رجوع", callback_data="back:subjects")
-    return InlineKeyboardMarkup([[fav_btn, del_confirm], [back_btn]])
+    return InlineKeyboardMarkup([[fav_btn, del_confirm], [BTN_BACK_SUBJECTS]])
 
-def manage_keyboard_viewer():
-    return InlineKeyboardMarkup([[InlineKeyboardButton("↩️ رجوع", callback_data="back:subjects")]])
+VIEWER_MANAGE_KB = InlineKeyboardMarkup([[BTN_BACK_SUBJECTS]])
 
 def trash_keyboard(rows):
     items = []
     for r in rows:
         fid = int(r["id"])
-        name = (r["filename"] or "").strip() or (r["caption"] or f"file_{fid}")
-        clean = name.replace("\n", " ").strip()
-        if len(clean) > 24:
-            clean = clean[:21] + "…"
+        name = r["filename"] or r["caption"] or f"file_{fid}"
+        clean = button_label(name, 24)
         items.append(InlineKeyboardButton(f"🗑️ {clean} (#{fid})", callback_data=f"trashopen:{fid}"))
 
     buttons = []
     for i in range(0, len(items), 2):
         buttons.append(items[i:i+2])
-    buttons.append([InlineKeyboardButton("↩️ رجوع", callback_data="back:home")])
+    buttons.append([BTN_BACK_HOME])
     return InlineKeyboardMarkup(buttons)
 
+@lru_cache(maxsize=256)
 def trash_manage_keyboard(file_id: int):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("♻️ استرجاع", callback_data=f"restore:{file_id}")],
@@ -673,25 +1156,50 @@ def trash_manage_keyboard(file_id: int):
         [InlineKeyboardButton("↩️ رجوع للسلة", callback_data="back:trash")]
     ])
 
+_FAV_MARK = ("", "⭐")  # is_fav عمود NOT NULL (0/1) فيصير index مباشر
+
+@lru_cache(maxsize=2048)
+def _format_file_line(fid: int, subj: str, filename, caption, added_at, is_fav: int) -> str:
+    # filename ينحفظ بعد safe_filename (مقصوص مسبقاً) فما نحتاج strip هنا
+    name = filename or caption or f"file_{fid}"
+    return f"{_FAV_MARK[is_fav]}{SUBJECT_EMOJI.get(subj, '📘')} <b>{subj}</b> | #{fid} | {name} | {added_at}"
+
 def pretty_file_line(r):
-    subj = r["subject"]
-    emoji = SUBJECT_EMOJI.get(subj, "📘")
-    name = (r["filename"] or "").strip() or (r["caption"] or f"file_{r['id']}")
-    fav = "⭐" if r["is_fav"] else ""
-    return f"{fav}{emoji} <b>{subj}</b> | #{r['id']} | {name} | {r['added_at']}"
+    # المفتاح يشمل كل الحقول المعروضة (ومنها is_fav) فما يحتاج invalidation
+    return _format_file_line(r["id"], r["subject"], r["filename"], r["caption"], r["added_at"], r["is_fav"])
 
 # ============================================================
 # Handlers
 # ============================================================
+# نصوص ثابتة: تنبني مرة وحدة بدل كل رسالة
+START_TEXT = (
+    "👋 أهلاً وسهلاً بك\n"
+    "📚 هذا بوت أرشفة خاص بمواد الجامعة\n\n"
+    "⬇️ اضغط من القائمة واختر المادة التي تريدها"
+)
+
+_HELP_BASE = (
+    "ℹ️ مساعدة:\n"
+    "• 📚 المواد: عرض المواد.\n"
+    "• 🧾 آخر الملفات: آخر الأرشيف.\n"
+    "• ⭐ المفضلة.\n"
+    "• 🔎 بحث.\n"
+    "• 📦 نسخة احتياطية: يدوي.\n"
+)
+HELP_TEXT_ADMIN = _HELP_BASE + (
+    "\n👑 أوامر الأدمن:\n"
+    "• اكتب اسم المادة ثم ارسل ملفات لإضافتها.\n"
+    "• 🗑️ سلة المهملات: إدارة المحذوفات.\n"
+    "• /restore_latest لاسترجاع DB من آخر Backup.\n"
+    "• /purge_trash تنظيف سلة المحذوفات.\n"
+    "• /health فحص الحالة.\n"
+)
+HELP_TEXT_VIEWER = _HELP_BASE + "\n👀 أنت Viewer: تقدر تشوف وتفتح الملفات فقط."
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     uid = update.effective_user.id
-    text = (
-        "👋 أهلاً وسهلاً بك\n"
-        "📚 هذا بوت أرشفة خاص بمواد الجامعة\n\n"
-        "⬇️ اضغط من القائمة واختر المادة التي تريدها"
-    )
-    await update.message.reply_text(text, reply_markup=main_keyboard_for(uid))
+    await update.message.reply_text(START_TEXT, reply_markup=main_keyboard_for(uid))
     log.info("start: uid=%s admin=%s", uid, is_admin(uid))
 
 async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -700,108 +1208,104 @@ async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    admin = is_admin(uid)
-    msg = (
-        "ℹ️ مساعدة:\n"
-        "• 📚 المواد: عرض المواد.\n"
-        "• 🧾 آخر الملفات: آخر الأرشيف.\n"
-        "• ⭐ المفضلة.\n"
-        "• 🔎 بحث.\n"
-        "• 📦 نسخة احتياطية: يدوي.\n"
-    )
-    if admin:
-        msg += (
-            "\n👑 أوامر الأدمن:\n"
-            "• اكتب اسم المادة ثم ارسل ملفات لإضافتها.\n"
-            "• 🗑️ سلة المهملات: إدارة المحذوفات.\n"
-            "• /restore_latest لاسترجاع DB من آخر Backup.\n"
-            "• /purge_trash تنظيف سلة المحذوفات.\n"
-            "• /health فحص الحالة.\n"
-        )
+    if is_admin(uid):
+        await update.message.reply_text(HELP_TEXT_ADMIN, reply_markup=MAIN_KB_ADMIN)
     else:
-        msg += "\n👀 أنت Viewer: تقدر تشوف وتفتح الملفات فقط."
-    await update.message.reply_text(msg, reply_markup=main_keyboard_for(uid))
+        await update.message.reply_text(HELP_TEXT_VIEWER, reply_markup=MAIN_KB_VIEWER)
 
 def get_fixed_subject(context: ContextTypes.DEFAULT_TYPE):
     subj = context.user_data.get("fixed_subject")
     until = context.user_data.get("fixed_until", 0)
-    if subj and datetime.utcnow().timestamp() <= until:
+    if subj and time.monotonic() <= until:
         return subj
-    context.user_data.pop("fixed_subject", None)
-    context.user_data.pop("fixed_until", None)
+    clear_modes(context.user_data, "fixed_subject", "fixed_until")
     return None
 
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (update.message.text or "").strip()
-    uid = update.effective_user.id
+# ---------------------------
+# MENU (أزرار الكيبورد الرئيسي)
+# ---------------------------
+async def menu_subjects(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    counts = await subject_counts(LIBRARY_ID)
+    await update.message.reply_text("📚 المواد:\n👇 اضغط مادة", reply_markup=subjects_keyboard(counts))
 
-    if context.user_data.get("search_mode"):
-        context.user_data["search_mode"] = False
-        rows = search_files(LIBRARY_ID, text)
-        if not rows:
-            await update.message.reply_text("🔎 ماكو نتائج.", reply_markup=main_keyboard_for(uid))
-            return
-        msg = "🔎 نتائج البحث:\n\n" + "\n".join(pretty_file_line(r) for r in rows)
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
+async def menu_recent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    rows = await list_recent(LIBRARY_ID, 12)
+    if not rows:
+        await update.message.reply_text("ماكو أرشيف بعد.", reply_markup=main_keyboard_for(uid))
         return
+    msg = "🧾 آخر الملفات:\n\n" + "\n".join(map(pretty_file_line, rows))
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
 
-    if text == "📚 المواد":
-        await update.message.reply_text("📚 المواد:\n👇 اضغط مادة", reply_markup=subjects_keyboard(LIBRARY_ID))
+async def menu_favorites(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    rows = await list_favorites(LIBRARY_ID, 50)
+    if not rows:
+        await update.message.reply_text("⭐ ماكو مفضلة بعد.", reply_markup=main_keyboard_for(uid))
         return
+    msg = "⭐ المفضلة:\n\n" + "\n".join(map(pretty_file_line, rows))
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
 
-    if text == "🧾 آخر الملفات":
-        rows = list_recent(LIBRARY_ID, 12)
-        if not rows:
-            await update.message.reply_text("ماكو أرشيف بعد.", reply_markup=main_keyboard_for(uid))
-            return
-        msg = "🧾 آخر الملفات:\n\n" + "\n".join(pretty_file_line(r) for r in rows)
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
-        return
+async def menu_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    context.user_data["search_mode"] = True
+    await update.message.reply_text("🔎 اكتب كلمة من اسم الملف/الوصف:", reply_markup=main_keyboard_for(uid))
 
-    if text == "⭐ المفضلة":
-        rows = list_favorites(LIBRARY_ID, 50)
-        if not rows:
-            await update.message.reply_text("⭐ ماكو مفضلة بعد.", reply_markup=main_keyboard_for(uid))
-            return
-        msg = "⭐ المفضلة:\n\n" + "\n".join(pretty_file_line(r) for r in rows)
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
+async def menu_trash(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        await update.message.reply_text("⛔ للأدمن فقط.", reply_markup=main_keyboard_for(uid))
         return
-
-    if text == "🔎 بحث":
-        context.user_data["search_mode"] = True
-        await update.message.reply_text("🔎 اكتب كلمة من اسم الملف/الوصف:", reply_markup=main_keyboard_for(uid))
+    rows = await list_trash(LIBRARY_ID, 50)
+    if not rows:
+        await update.message.reply_text("🗑️ السلة فارغة.", reply_markup=main_keyboard_for(uid))
         return
+    await update.message.reply_text("🗑️ سلة المهملات — اختر ملف:", reply_markup=trash_keyboard(rows))
 
-    if text == "🗑️ سلة المهملات":
-        if not is_admin(uid):
-            await update.message.reply_text("⛔ للأدمن فقط.", reply_markup=main_keyboard_for(uid))
-            return
-        rows = list_trash(LIBRARY_ID, 50)
-        if not rows:
-            await update.message.reply_text("🗑️ السلة فارغة.", reply_markup=main_keyboard_for(uid))
-            return
-        await update.message.reply_text("🗑️ سلة المهملات — اختر ملف:", reply_markup=trash_keyboard(rows))
+async def menu_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        await update.message.reply_text("⛔ النسخ الاحتياطي للأدمن فقط.", reply_markup=main_keyboard_for(uid))
         return
+    try:
+        backup_path = await create_backup()
+        data = await read_file_bytes(backup_path)
+        await update.message.reply_document(document=data, filename=backup_path.name, caption="📦 Backup (DB)")
+        log.info("manual backup: uid=%s file=%s", uid, backup_path.name)
+    except Exception as e:
+        log.exception("manual backup failed: %s", e)
+        await update.message.reply_text(f"❌ فشل النسخ: {e}", reply_markup=main_keyboard_for(uid))
+
+# نص الزر -> handler (lookup واحد بدل سلسلة if)
+MENU_ROUTES = {
+    "📚 المواد": menu_subjects,
+    "🧾 آخر الملفات": menu_recent,
+    "⭐ المفضلة": menu_favorites,
+    "🔎 بحث": menu_search,
+    "🗑️ سلة المهملات": menu_trash,
+    "📦 نسخة احتياطية": menu_backup,
+    "ℹ️ مساعدة": help_cmd,
+}
 
-    if text == "📦 نسخة احتياطية":
-        if not is_admin(uid):
-            await update.message.reply_text("⛔ النسخ الاحتياطي للأدمن فقط.", reply_markup=main_keyboard_for(uid))
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (update.message.text or "").strip()
+    uid = update.effective_user.id
+
+    route = MENU_ROUTES.get(text)
+    # زر قائمة أثناء البحث = المستخدم غيّر رأيه؛ ما نبحث عن نص الزر
+    if context.user_data.get("search_mode"):
+        context.user_data["search_mode"] = False
+        if not route:
+            rows = await search_files(LIBRARY_ID, text)
+            if not rows:
+                await update.message.reply_text("🔎 ماكو نتائج.", reply_markup=main_keyboard_for(uid))
+                return
+            msg = "🔎 نتائج البحث:\n\n" + "\n".join(map(pretty_file_line, rows))
+            await update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=main_keyboard_for(uid))
             return
-        try:
-            backup_name = make_backup_name()
-            backup_path = Path(BACKUP_DIR) / backup_name
-            make_sqlite_backup(str(backup_path))
-            cleanup_old_backups()
-            with open(backup_path, "rb") as f:
-                await update.message.reply_document(document=f, filename=backup_name, caption="📦 Backup (DB)")
-            log.info("manual backup: uid=%s file=%s", uid, backup_name)
-        except Exception as e:
-            log.exception("manual backup failed: %s", e)
-            await update.message.reply_text(f"❌ فشل النسخ: {e}", reply_markup=main_keyboard_for(uid))
-        return
 
-    if text == "ℹ️ مساعدة":
-        await help_cmd(update, context)
+    if route:
+        await route(update, context)
         return
 
     subj = normalize_subject(text)
@@ -810,7 +1314,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("👀 تقدر تتصفح فقط. إضافة ملفات للأدمن فقط.", reply_markup=main_keyboard_for(uid))
             return
         context.user_data["fixed_subject"] = subj
-        context.user_data["fixed_until"] = datetime.utcnow().timestamp() + (10 * 60)
+        # monotonic: ما يتأثر بتغيير ساعة السيرفر (user_data بالذاكرة فقط)
+        context.user_data["fixed_until"] = time.monotonic() + (10 * 60)
         emoji = SUBJECT_EMOJI.get(subj, "📘")
         await update.message.reply_text(
             f"✅ ثبتت المادة مؤقتاً: {emoji} <b>{subj}</b>\n"
@@ -822,37 +1327,85 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text("ما فهمت 😅\nاضغط 📚 المواد أو 🔎 بحث.", reply_markup=main_keyboard_for(uid))
 
-def extract_tg_unique_id(message) -> str | None:
-    try:
-        if message.document:
-            return message.document.file_unique_id
-        if message.photo:
-            return message.photo[-1].file_unique_id
-        if message.video:
-            return message.video.file_unique_id
-        if message.audio:
-            return message.audio.file_unique_id
-        if message.voice:
-            return message.voice.file_unique_id
-    except Exception:
-        pass
+# (file_type, اسم افتراضي, نستخدم file_name الأصلي؟) — بالترتيب: أول نوع موجود يفوز
+_FILE_KINDS = (
+    ("document", None, True),
+    ("photo", "photo.jpg", False),
+    ("video", "video.mp4", False),
+    ("audio", "audio.mp3", True),
+    ("voice", "voice.ogg", False),
+)
+
+def extract_media(message):
+    """
+    يرجّع (file_type, media, orig_name) لأول نوع مدعوم بالرسالة، أو None.
+    """
+    for file_type, default_name, use_name in _FILE_KINDS:
+        media = getattr(message, file_type, None)
+        if not media:
+            continue
+        if file_type == "photo":
+            media = media[-1]  # أكبر دقة
+        orig_name = (getattr(media, "file_name", None) if use_name else None) or default_name
+        return file_type, media, orig_name
     return None
 
-def extract_file_size(message) -> int | None:
+# ---------------------------
+# ALBUMS (media groups): رسالة ملخص وحدة بدل رسالة لكل ملف
+# ---------------------------
+# media_group_id -> {"pending": عدد الملفات قيد المعالجة, "lines": [...], "timer": TimerHandle, ...}
+_albums = {}
+
+def album_begin(album_id: str, chat_id: int, uid: int, subj: str):
+    a = _albums.get(album_id)
+    if a is None:
+        a = _albums[album_id] = {"pending": 0, "lines": [], "rows": [], "timer": None, "chat_id": chat_id, "uid": uid, "subj": subj}
+    a["pending"] += 1
+    if a["timer"] is not None:
+        a["timer"].cancel()
+        a["timer"] = None
+
+def album_add_row(album_id: str, params: tuple, fut) -> bool:
+    """
+    يحجز صف الألبوم لحد ما كل الملفات الشغالة توصل للإدخال. False = ماكو ألبوم.
+    """
+    a = _albums.get(album_id)
+    if a is None:
+        return False
+    a["rows"].append((params, fut))
+    _flush_album_rows(a)
+    return True
+
+def _flush_album_rows(a: dict):
+    # كل ملف لسه شغال حاط صفه (الباقي خلص بدون صف: تكرار/فشل) = دفعة وحدة
+    if a["rows"] and len(a["rows"]) == a["pending"]:
+        batch, a["rows"] = a["rows"], []
+        _spawn(_write_insert_batch(batch))
+
+def album_done(album_id: str, line: str, context: ContextTypes.DEFAULT_TYPE):
+    a = _albums.get(album_id)
+    if a is None:
+        return
+    a["lines"].append(line)
+    a["pending"] -= 1
+    _flush_album_rows(a)
+    if a["pending"] <= 0:
+        # ننتظر شوية: تيليجرام ممكن يرسل باقي الألبوم بعد ما خلص أول ملف
+        a["timer"] = asyncio.get_running_loop().call_later(ALBUM_SUMMARY_DELAY, _start_album_summary, album_id, context)
+
+def _start_album_summary(album_id: str, context: ContextTypes.DEFAULT_TYPE):
+    a = _albums.pop(album_id, None)
+    if not a:
+        return
+    _spawn(_send_album_summary(a, context))
+
+async def _send_album_summary(a: dict, context: ContextTypes.DEFAULT_TYPE):
+    emoji = SUBJECT_EMOJI.get(a["subj"], "📘")
+    text = f"📦 ألبوم: {len(a['lines'])} ملف → {emoji} {a['subj']}\n" + "\n".join(a["lines"])
     try:
-        if message.document:
-            return message.document.file_size
-        if message.photo:
-            return message.photo[-1].file_size
-        if message.video:
-            return message.video.file_size
-        if message.audio:
-            return message.audio.file_size
-        if message.voice:
-            return message.voice.file_size
-    except Exception:
-        pass
-    return None
+        await context.bot.send_message(chat_id=a["chat_id"], text=text, reply_markup=main_keyboard_for(a["uid"]))
+    except Exception as e:
+        log.warning("album summary failed: %s", e)
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -868,58 +1421,71 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     caption = (msg.caption or "").strip() or None
 
-    file_type = None
-    tg_file_id = None
-    orig_name = None
-
-    if msg.document:
-        file_type = "document"
-        tg_file_id = msg.document.file_id
-        orig_name = msg.document.file_name
-    elif msg.photo:
-        file_type = "photo"
-        tg_file_id = msg.photo[-1].file_id
-        orig_name = "photo.jpg"
-    elif msg.video:
-        file_type = "video"
-        tg_file_id = msg.video.file_id
-        orig_name = "video.mp4"
-    elif msg.audio:
-        file_type = "audio"
-        tg_file_id = msg.audio.file_id
-        orig_name = msg.audio.file_name or "audio.mp3"
-    elif msg.voice:
-        file_type = "voice"
-        tg_file_id = msg.voice.file_id
-        orig_name = "voice.ogg"
-    else:
+    media = extract_media(msg)
+    if not media:
         await update.message.reply_text("⚠️ نوع غير مدعوم.", reply_markup=main_keyboard_for(uid))
         return
+    file_type, media, orig_name = media
 
-    file_size = extract_file_size(msg)
+    # ألبوم: بدون رسالة تحميل لكل ملف؛ النتائج تتجمع برسالة ملخص وحدة
+    album_id = msg.media_group_id
+    if album_id:
+        album_begin(album_id, update.effective_chat.id, uid, subj)
+        line = "❌ خطأ غير متوقع"
+        try:
+            _, line = await _archive_file(update, context, subj, file_type, media, orig_name, caption, None, album_id)
+        finally:
+            album_done(album_id, line, context)
+        return
+
+    text, _ = await _archive_file(update, context, subj, file_type, media, orig_name, caption, "⬇️ جاري التحميل…")
+    if text:
+        await update.message.reply_text(text, reply_markup=main_keyboard_for(uid))
+
+async def _archive_file(update: Update, context: ContextTypes.DEFAULT_TYPE, subj: str, file_type: str, media, orig_name, caption, status_text, album_id=None):
+    """
+    تنزيل + dedup + حفظ ملف واحد.
+    يرجّع (نص للرد, سطر مختصر لملخص الألبوم). النص None إذا انكتبت النتيجة برسالة الحالة.
+    """
+    uid = update.effective_user.id
+    chat_id = update.effective_chat.id
+    tg_file_id = media.file_id
+    file_size = media.file_size
 
     # 1) Dedup سريع بـ Telegram unique id
-    tg_unique_id = extract_tg_unique_id(msg)
+    tg_unique_id = media.file_unique_id
+    revive_id = None
     if tg_unique_id:
-        existing_u = get_file_by_unique(LIBRARY_ID, tg_unique_id)
-        if existing_u and int(existing_u["is_deleted"] or 0) == 0:
-            await update.message.reply_text(
+        existing_u = await get_file_by_unique(LIBRARY_ID, tg_unique_id)
+        if existing_u and int(existing_u["is_deleted"] or 0) == 1:
+            revive_id = int(existing_u["id"])
+        elif existing_u:
+            ex_id = int(existing_u["id"])
+            return (
                 "⚠️ هذا الملف موجود مسبقاً بالمكتبة (Telegram Unique ID).\n"
-                f"• رقم الملف: #{int(existing_u['id'])}\n"
+                f"• رقم الملف: #{ex_id}\n"
                 "✅ ما راح أضيف نسخة ثانية.",
-                reply_markup=main_keyboard_for(uid),
+                f"⚠️ موجود مسبقاً: #{ex_id}",
             )
-            return
 
     emoji = SUBJECT_EMOJI.get(subj, "📘")
     subject_dir = Path(FILES_DIR) / subj
     subject_dir.mkdir(parents=True, exist_ok=True)
 
-    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    ts = time.strftime("%Y%m%d_%H%M%S", time.gmtime())
     safe_name = safe_filename(orig_name, f"{file_type}_{ts}")
-    local_path = subject_dir / f"{ts}_{safe_name}"
+    # uuid بالمسار: مع concurrent_updates ملفات الألبوم (كلها photo.jpg) تتنزل بنفس الثانية،
+    # فلازم كل تنزيل ملفه الخاص وإلا تكتب فوق بعض ويمسح واحد ملف الثاني
+    local_path = subject_dir / f"{ts}_{uuid.uuid4().hex[:12]}_{safe_name}"
 
-    status_msg = await update.message.reply_text("⬇️ جاري التحميل…", reply_markup=main_keyboard_for(uid))
+    status_msg = None
+    if status_text:
+        status_msg = await update.message.reply_text(status_text, reply_markup=main_keyboard_for(uid))
+
+    async def finish(text: str, line: str):
+        if status_msg is not None:
+            await finalize_status(status_msg, context, chat_id, text, reply_markup=main_keyboard_for(uid))
+        return None, line
 
     # تنزيل الملف
     try:
@@ -927,18 +1493,17 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await tg_file.download_to_drive(custom_path=str(local_path))
     except Exception as e:
         log.exception("download failed: %s", e)
-        await finalize_status(status_msg, context, update.effective_chat.id, f"❌ فشل تنزيل الملف: {e}", reply_markup=main_keyboard_for(uid))
-        return
+        return await finish(f"❌ فشل تنزيل الملف: {e}", f"❌ فشل التنزيل: {safe_name}")
 
     # 2) Dedup الحقيقي: SHA256
     try:
-        content_hash = sha256_file(local_path)
+        content_hash = await _in_thread(sha256_file, local_path)
     except Exception as e:
         log.exception("hash failed: %s", e)
         content_hash = None
 
     if content_hash:
-        existing_h = get_file_by_hash(LIBRARY_ID, content_hash)
+        existing_h = await get_file_by_hash(LIBRARY_ID, content_hash)
         if existing_h:
             try:
                 local_path.unlink(missing_ok=True)
@@ -947,48 +1512,17 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             ex_id = int(existing_h["id"])
             ex_subj = existing_h["subject"]
-            await finalize_status(
-                status_msg,
-                context,
-                update.effective_chat.id,
+            return await finish(
                 "⚠️ نفس محتوى الملف موجود مسبقاً بالمكتبة (SHA-256).\n"
                 f"• المادة: {ex_subj}\n"
                 f"• رقم الملف: #{ex_id}\n"
                 "✅ ما راح أضيف نسخة ثانية.",
-                reply_markup=main_keyboard_for(uid),
-            )
-            return
-
-    # إذا الملف كان موجود بالـunique_id ومحذوف -> رجّعه بدل إضافة
-    if tg_unique_id:
-        existing_u = get_file_by_unique(LIBRARY_ID, tg_unique_id)
-        if existing_u and int(existing_u["is_deleted"] or 0) == 1:
-            ex_id = int(existing_u["id"])
-            update_existing_file_from_duplicate(
-                user_id=LIBRARY_ID,
-                existing_id=ex_id,
-                tg_file_id=tg_file_id,
-                filename=safe_name,
-                caption=caption,
-                local_path=str(local_path),
-                file_size=file_size,
-                content_hash=content_hash,
+                f"⚠️ نفس المحتوى موجود: #{ex_id} ({ex_subj})",
             )
-            await finalize_status(
-                status_msg,
-                context,
-                update.effective_chat.id,
-                "♻️ هذا الملف كان موجود بالسلة وتم استرجاعه بدل ما نضيف نسخة مكررة.\n"
-                f"{emoji} {subj}\n"
-                f"رقم: #{ex_id}\n"
-                "✅ تم الحفظ المحلي.",
-                reply_markup=main_keyboard_for(uid),
-            )
-            return
 
-    # إدخال جديد
+    # إدخال جديد (أو استرجاع من السلة عبر الـupsert إذا نفس الـunique_id محذوف)
     try:
-        new_id = add_file_row(
+        new_id = await add_file_row(
             user_id=LIBRARY_ID,
             subject=subj,
             file_type=file_type,
@@ -999,58 +1533,71 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             local_path=str(local_path),
             file_size=file_size,
             content_hash=content_hash,
+            album_id=album_id,
         )
     except sqlite3.IntegrityError:
         try:
             local_path.unlink(missing_ok=True)
         except Exception:
             pass
-        await finalize_status(status_msg, context, update.effective_chat.id, "⚠️ تكرار (منعته قاعدة البيانات).", reply_markup=main_keyboard_for(uid))
-        return
+        return await finish("⚠️ تكرار (منعته قاعدة البيانات).", f"⚠️ تكرار: {safe_name}")
+
+    if new_id == revive_id:
+        return await finish(
+            "♻️ هذا الملف كان موجود بالسلة وتم استرجاعه بدل ما نضيف نسخة مكررة.\n"
+            f"{emoji} {subj}\n"
+            f"رقم: #{new_id}\n"
+            "✅ تم الحفظ المحلي.",
+            f"♻️ استرجاع من السلة: #{new_id}",
+        )
 
     log.info("file added: uid=%s subj=%s id=%s name=%s size=%s", uid, subj, new_id, safe_name, file_size)
-    await finalize_status(
-        status_msg,
-        context,
-        update.effective_chat.id,
+    return await finish(
         f"✅ تمت الإضافة للمكتبة العامة!\n"
         f"{emoji} {subj}\n"
         f"رقم: #{new_id}\n"
         "✅ تم الحفظ المحلي.",
-        reply_markup=main_keyboard_for(uid),
+        f"✅ #{new_id} {safe_name}",
     )
 
 # ============================================================
 # CALLBACKS (مُحسنة: edit بدل تكديس)
 # ============================================================
-async def cb_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_subject(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
     query = update.callback_query
     await query.answer()
-    subject = query.data.split(":", 1)[1]
-    rows = list_files_by_subject(LIBRARY_ID, subject, 50)
+    # subj:<subject>[:<before_id>]
+    subject, _, before = arg.partition(":")
+    if subject not in SUBJECT_SET:
+        return  # callback قديم/معدّل: ما نستعلم ولا نعبي الكاش بمفاتيح غريبة
+    before_id = int(before) if before.isdecimal() else 0
+    # صف زيادة يكفي لنعرف إذا أكو صفحة أقدم (بدون استعلام ثاني)
+    rows = await list_files_by_subject(LIBRARY_ID, subject, SUBJECT_PAGE_SIZE + 1, before_id)
+    has_more = len(rows) > SUBJECT_PAGE_SIZE
+    rows = rows[:SUBJECT_PAGE_SIZE]
     emoji = SUBJECT_EMOJI.get(subject, "📘")
     if not rows:
         await safe_edit_or_send(query, f"{emoji} {subject}\nماكو ملفات بعد.", reply_markup=None)
         return
+    cnt = (await subject_counts(LIBRARY_ID)).get(subject, 0)
     await safe_edit_or_send(
         query,
-        f"{emoji} <b>{subject}</b> — اختر ملف:",
+        f"{emoji} <b>{subject}</b> ({cnt}) — اختر ملف:",
         parse_mode=ParseMode.HTML,
-        reply_markup=files_keyboard(rows),
+        reply_markup=files_keyboard(rows, subject, before_id, has_more),
     )
 
-async def cb_open_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_open_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    file_id = int(query.data.split(":", 1)[1])
 
-    row = get_file_by_id(LIBRARY_ID, file_id)
+    row = await get_file_by_id(LIBRARY_ID, file_id)
     if not row or int(row["is_deleted"] or 0) == 1:
         await query.message.reply_text("❌ الملف غير موجود.")
         return
 
-    filename = (row["filename"] or "").strip() or f"file_{file_id}"
+    filename = row["filename"] or f"file_{file_id}"
     caption = row["caption"] or filename
     local_path = row["local_path"]
     sent = False
@@ -1059,21 +1606,17 @@ async def cb_open_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         p = Path(local_path)
         if p.exists() and p.is_file():
             try:
+                data = await read_file_bytes(p)
                 if row["file_type"] == "photo":
-                    with open(p, "rb") as f:
-                        await query.message.reply_photo(photo=f, caption=caption)
+                    await query.message.reply_photo(photo=data, caption=caption, filename=p.name)
                 elif row["file_type"] == "video":
-                    with open(p, "rb") as f:
-                        await query.message.reply_video(video=f, caption=caption)
+                    await query.message.reply_video(video=data, caption=caption, filename=p.name)
                 elif row["file_type"] == "audio":
-                    with open(p, "rb") as f:
-                        await query.message.reply_audio(audio=f, caption=caption)
+                    await query.message.reply_audio(audio=data, caption=caption, filename=p.name)
                 elif row["file_type"] == "voice":
-                    with open(p, "rb") as f:
-                        await query.message.reply_voice(voice=f, caption=caption)
+                    await query.message.reply_voice(voice=data, caption=caption, filename=p.name)
                 else:
-                    with open(p, "rb") as f:
-                        await query.message.reply_document(document=f, caption=caption, filename=filename)
+                    await query.message.reply_document(document=data, caption=caption, filename=filename)
                 sent = True
             except Exception:
                 sent = False
@@ -1109,33 +1652,28 @@ async def cb_open_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=manage_keyboard_admin(file_id, is_fav_val, is_deleted_val),
         )
     else:
-        await query.message.reply_text("✅", reply_markup=manage_keyboard_viewer())
+        await query.message.reply_text("✅", reply_markup=VIEWER_MANAGE_KB)
 
-async def cb_fav(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_fav(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ هذا الخيار للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    row = get_file_by_id(LIBRARY_ID, file_id)
-    if not row or int(row["is_deleted"] or 0) == 1:
+    if await toggle_fav(LIBRARY_ID, file_id) is None:
         await query.message.reply_text("❌ الملف غير موجود.")
         return
-    new_fav = 0 if int(row["is_fav"] or 0) else 1
-    set_fav(LIBRARY_ID, file_id, new_fav)
     await query.message.reply_text("⭐ تم تحديث المفضلة.")
 
-async def cb_del_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_del_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ هذا الخيار للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    row = get_file_by_id(LIBRARY_ID, file_id)
+    row = await get_file_by_id(LIBRARY_ID, file_id)
     if not row or int(row["is_deleted"] or 0) == 1:
         await query.message.reply_text("❌ الملف غير موجود.")
         return
@@ -1145,86 +1683,81 @@ async def cb_del_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ])
     await query.message.reply_text("🗑️ تأكيد الحذف؟ (سيروح للسلة ويمكن استرجاعه)", reply_markup=kb)
 
-async def cb_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_del(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ هذا الخيار للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    soft_delete_file(LIBRARY_ID, file_id)
+    await soft_delete_file(LIBRARY_ID, file_id)
     await query.message.reply_text("🗑️ تم نقل الملف إلى السلة (Soft Delete).")
 
-async def cb_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_restore(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    restore_file(LIBRARY_ID, file_id)
+    await restore_file(LIBRARY_ID, file_id)
     await query.message.reply_text("♻️ تم استرجاع الملف.")
 
-async def cb_trash_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_trash_open(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    row = get_file_by_id(LIBRARY_ID, file_id)
+    row = await get_file_by_id(LIBRARY_ID, file_id)
     if not row or int(row["is_deleted"] or 0) != 1:
         await query.message.reply_text("❌ الملف غير موجود في السلة.")
         return
 
-    name = (row["filename"] or "").strip() or (row["caption"] or f"file_{file_id}")
+    name = row["filename"] or row["caption"] or f"file_{file_id}"
     subj = row["subject"]
     emoji = SUBJECT_EMOJI.get(subj, "📘")
     deleted_at = row["deleted_at"] or "-"
     msg = f"🗑️ <b>داخل السلة</b>\n{emoji} {subj}\n#{file_id}\n{name}\n\n🕒 {deleted_at}"
     await safe_edit_or_send(query, msg, parse_mode=ParseMode.HTML, reply_markup=trash_manage_keyboard(file_id))
 
-async def cb_hard_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_hard_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ نعم حذف نهائي", callback_data=f"hard:{file_id}"),
          InlineKeyboardButton("❌ تراجع", callback_data="back:trash")]
     ])
     await query.message.reply_text("⚠️ حذف نهائي؟ (ماكو رجعة)", reply_markup=kb)
 
-async def cb_hard_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_hard_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
     if not is_admin(uid):
         await query.message.reply_text("⛔ للأدمن فقط.")
         return
-    file_id = int(query.data.split(":", 1)[1])
-    hard_delete_file(LIBRARY_ID, file_id)
+    await hard_delete_file(LIBRARY_ID, file_id)
     await query.message.reply_text("❌ تم حذف الملف نهائيًا من السلة.")
 
-async def cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE, where: str):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    where = query.data.split(":", 1)[1]
 
     if where == "subjects":
-        await safe_edit_or_send(query, "📚 المواد:\n👇 اضغط مادة", reply_markup=subjects_keyboard(LIBRARY_ID))
+        counts = await subject_counts(LIBRARY_ID)
+        await safe_edit_or_send(query, "📚 المواد:\n👇 اضغط مادة", reply_markup=subjects_keyboard(counts))
     elif where == "trash":
         if not is_admin(uid):
             await query.message.reply_text("⛔ للأدمن فقط.", reply_markup=main_keyboard_for(uid))
             return
-        rows = list_trash(LIBRARY_ID, 50)
+        rows = await list_trash(LIBRARY_ID, 50)
         if not rows:
             await safe_edit_or_send(query, "🗑️ السلة فارغة.", reply_markup=None)
             return
@@ -1237,6 +1770,33 @@ async def cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
         await query.message.reply_text("✅", reply_markup=main_keyboard_for(uid))
 
+# prefix -> (handler, الـarg لازم يكون رقم؟)
+CALLBACK_ROUTES = {
+    "subj": (cb_subject, False),
+    "open": (cb_open_file, True),
+    "fav": (cb_fav, True),
+    "del2": (cb_del_confirm, True),
+    "del": (cb_del, True),
+    "restore": (cb_restore, True),
+    "trashopen": (cb_trash_open, True),
+    "hard2": (cb_hard_confirm, True),
+    "hard": (cb_hard_delete, True),
+    "back": (cb_back, False),
+}
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    CallbackQueryHandler واحد: partition مرة وحدة + lookup بدل 10 regex بالترتيب.
+    """
+    query = update.callback_query
+    prefix, _, arg = (query.data or "").partition(":")
+    route = CALLBACK_ROUTES.get(prefix)
+    if not route or (route[1] and not arg.isdecimal()):
+        await query.answer()
+        return
+    handler, numeric = route
+    await handler(update, context, int(arg) if numeric else arg)
+
 # ============================================================
 # ADMIN COMMANDS
 # ============================================================
@@ -1246,10 +1806,11 @@ async def restore_latest(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ للأدمن فقط.")
         return
     log.warning("restore_latest called by uid=%s", uid)
-    msg = restore_from_latest_backup()
+    msg = await restore_from_latest_backup()
     await update.message.reply_text(msg)
     global LIBRARY_ID
-    detected = detect_library_id_legacy()
+    async with acquire_reader() as con:
+        detected = await _in_thread(detect_library_id_legacy, con)
     if detected:
         LIBRARY_ID = detected
 
@@ -1259,7 +1820,7 @@ async def purge_trash_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ للأدمن فقط.")
         return
     log.warning("purge_trash called by uid=%s", uid)
-    purge_trash(LIBRARY_ID)
+    await purge_trash(LIBRARY_ID)
     await update.message.reply_text("✅ تم تنظيف السلة حسب مدة الاحتفاظ.")
 
 async def health(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1272,22 +1833,11 @@ async def health(update: Update, context: ContextTypes.DEFAULT_TYPE):
     p_files = Path(FILES_DIR)
     p_bak = Path(BACKUP_DIR)
 
-    # فحص وجود index hash
-    has_hash_index = False
+    # فحص وجود index hash + أرقام سريعة
     try:
-        con = db()
-        cur = con.cursor()
-        cur.execute("PRAGMA index_list(files)")
-        idxs = [r[1] for r in cur.fetchall()]
-        has_hash_index = "idx_files_user_hash" in idxs
-        # أرقام سريعة
-        cur.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=0", (LIBRARY_ID,))
-        total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM files WHERE user_id=? AND is_deleted=1", (LIBRARY_ID,))
-        deleted = cur.fetchone()[0]
-        con.close()
+        has_hash_index, total, deleted = await library_stats(LIBRARY_ID)
     except Exception:
-        total, deleted = 0, 0
+        has_hash_index, total, deleted = False, 0, 0
 
     msg = (
         "🧪 Health Check:\n"
@@ -1314,22 +1864,36 @@ def main():
     init_db()
 
     global LIBRARY_ID
-    if LIBRARY_ID == 0:
-        detected = detect_library_id_legacy()
-        if detected:
-            LIBRARY_ID = detected
-        if LIBRARY_ID == 0 and OWNER_ID:
-            LIBRARY_ID = OWNER_ID
-
-    if LIBRARY_ID and not library_has_any_files(LIBRARY_ID):
-        detected2 = detect_library_id_legacy()
-        if detected2:
-            LIBRARY_ID = detected2
+    # اتصال واحد لكل فحوصات الـstartup
+    con = db()
+    try:
+        if LIBRARY_ID == 0:
+            detected = detect_library_id_legacy(con)
+            if detected:
+                LIBRARY_ID = detected
+            if LIBRARY_ID == 0 and OWNER_ID:
+                LIBRARY_ID = OWNER_ID
+
+        if LIBRARY_ID and not library_has_any_files(con, LIBRARY_ID):
+            detected2 = detect_library_id_legacy(con)
+            if detected2:
+                LIBRARY_ID = detected2
+    finally:
+        con.close()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(open_db_pool)
+        .post_shutdown(close_db_pool)
+        .build()
+    )
 
     if AUTO_BACKUP_MINUTES > 0:
         app.job_queue.run_repeating(auto_backup_job, interval=AUTO_BACKUP_MINUTES * 60, first=60)
+    if DB_OPTIMIZE_MINUTES > 0:
+        app.job_queue.run_repeating(optimize_db_job, interval=DB_OPTIMIZE_MINUTES * 60, first=DB_OPTIMIZE_MINUTES * 60)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
@@ -1338,18 +1902,7 @@ def main():
     app.add_handler(CommandHandler("purge_trash", purge_trash_cmd))
     app.add_handler(CommandHandler("health", health))
 
-    app.add_handler(CallbackQueryHandler(cb_subject, pattern=r"^subj:"))
-    app.add_handler(CallbackQueryHandler(cb_open_file, pattern=r"^open:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_fav, pattern=r"^fav:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_del_confirm, pattern=r"^del2:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_del, pattern=r"^del:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_restore, pattern=r"^restore:\d+$"))
-
-    app.add_handler(CallbackQueryHandler(cb_trash_open, pattern=r"^trashopen:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_hard_confirm, pattern=r"^hard2:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_hard_delete, pattern=r"^hard:\d+$"))
-
-    app.add_handler(CallbackQueryHandler(cb_back, pattern=r"^back:"))
+    app.add_handler(CallbackQueryHandler(on_callback))
 
     app.add_handler(
         MessageHandler(filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.VOICE, handle_file)